@@ -0,0 +1,41 @@
+import re
+
+# Categorization doesn't need Streamlit, so it lives here where the process pool's
+# workers can reference it without depending on the app script's functions
+
+# Payment method suffixes (CPM, CLP, BCC, DDR, BGC, STO, FT), stripped from the end
+# in that order, and date patterns like "ON XX XXX"
+SUFFIX_RE = re.compile(r'(?: FT)?(?: STO)?(?: BGC)?(?: DDR)?(?: BCC)?(?: CLP)?(?: CPM)?$')
+DATE_RE = re.compile(r'\s+ON\s+\d{2}\s+[A-Z]{3}')
+
+# Keyword automaton of the current worker process, set once by init_worker
+worker_automaton = None
+
+def clean_transaction_details(details):
+    # Remove payment method suffixes and dates, then multiple spaces
+    details = DATE_RE.sub('', SUFFIX_RE.sub('', details.upper().strip()))
+    return ' '.join(details.split())
+
+def categorize_transactions(df, automaton):
+    df["Category"] = "Uncategorized"
+    if automaton is None:
+        return df
+
+    # Clean each transaction's details once, in a single pass per row
+    cleaned_details = df["Details"].map(clean_transaction_details)
+
+    # Find all keywords of all categories in a single scan of each transaction
+    df["Category"] = [
+        max((match for _, match in automaton.iter(details)), default=(-1, "Uncategorized"))[1]
+        for details in cleaned_details
+    ]
+
+    return df
+
+def init_worker(automaton):
+    # Receive the automaton once per worker rather than with every chunk
+    global worker_automaton
+    worker_automaton = automaton
+
+def categorize_chunk(df):
+    return categorize_transactions(df, worker_automaton)
@@ -1,16 +1,32 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
 import json
+import io
 import os
+import hashlib
 from datetime import datetime
-import re
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import ahocorasick
+import pyarrow as pa
+import pyarrow.csv as pa_csv
+from categorization import categorize_chunk, categorize_transactions, clean_transaction_details, init_worker
 
 # Get the directory where main.py is located
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 category_file = os.path.join(SCRIPT_DIR, "categories.json")
 
+# Bytes of CSV parsed and categorized at a time, about 50,000 rows of a bank export
+CSV_BLOCK_SIZE = 4 * 1024 * 1024
+
+# Files with fewer rows than this are categorized without a process pool. Each spawned
+# worker re-imports this script as __mp_main__ (Streamlit, plotly, pyarrow, categories.json)
+# before it can start, so the pool only pays off for large files
+PARALLEL_MIN_ROWS = 100_000
+
 st.set_page_config(page_title="UK Finance Dashboard", page_icon="��", layout="wide")
 
 # Define default UK spending categories
@@ -34,69 +50,132 @@ DEFAULT_CATEGORIES = {
 }
 
 if "categories" not in st.session_state:
-    st.session_state.categories = DEFAULT_CATEGORIES
+    # Keywords are kept as sets in memory for O(1) membership checks
+    st.session_state.categories = {
+        category: set(keywords) for category, keywords in DEFAULT_CATEGORIES.items()
+    }
     
+@st.cache_resource(max_entries=1)
+def load_categories_from_disk(path, mtime):
+    # mtime keys the cache so the file is only re-read after it changes
+    with open(path, "r") as f:
+        return json.load(f)
+
 if os.path.exists(category_file):
-    with open(category_file, "r") as f:
-        st.session_state.categories = json.load(f)
+    saved_categories = load_categories_from_disk(category_file, os.path.getmtime(category_file))
+    # Copy the cached dict so session edits don't mutate it for other sessions
+    st.session_state.categories = {
+        category: set(keywords) for category, keywords in saved_categories.items()
+    }
+
+def categories_to_json(categories):
+    # Keyword sets are stored as sorted lists so the file is stable between saves
+    return {category: sorted(keywords) for category, keywords in categories.items()}
 
 def save_categories():
     with open(category_file, "w") as f:
-        json.dump(st.session_state.categories, f)
+        json.dump(categories_to_json(st.session_state.categories), f)
+    # Drop automatons built from the previous keyword lists
+    build_keyword_automaton.clear()
 
-def clean_transaction_details(details):
-    # Remove common payment method suffixes and clean up the string
-    details = details.upper().strip()
-    # Remove payment methods and dates
-    suffixes_to_remove = [' CPM', ' CLP', ' BCC', ' DDR', ' BGC', ' STO', ' FT']
-    for suffix in suffixes_to_remove:
-        if details.endswith(suffix):
-            details = details[:-len(suffix)]
-    # Remove date patterns like "ON XX XXX"
-    details = re.sub(r'\s+ON\s+\d{2}\s+[A-Z]{3}', '', details)
-    # Remove multiple spaces
-    details = ' '.join(details.split())
-    return details
+def hash_categories(categories):
+    # Category order decides which category wins a match, so it is part of the hash
+    return hashlib.md5(json.dumps(categories_to_json(categories)).encode()).hexdigest()
 
-def categorize_transactions(df):
-    df["Category"] = "Uncategorized"
-    
-    for category, keywords in st.session_state.categories.items():
-        if category == "Uncategorized" or not keywords:
+@st.cache_resource
+def build_keyword_automaton(_categories, categories_hash):
+    # Map every keyword to its category, tagged with the category's position so
+    # that the last matching category wins, as with the old per-category loop
+    automaton = ahocorasick.Automaton()
+    for priority, (category, keywords) in enumerate(_categories.items()):
+        if category == "Uncategorized":
             continue
-        
-        for idx, row in df.iterrows():
-            # Clean the transaction details before matching
-            cleaned_details = clean_transaction_details(row["Details"])
-            # Clean and compare keywords
-            if any(keyword.upper() in cleaned_details for keyword in keywords):
-                df.at[idx, "Category"] = category
-                
-    return df
+        for keyword in keywords:
+            automaton.add_word(keyword.upper(), (priority, category))
+    if automaton.kind == ahocorasick.EMPTY:
+        return None
+    automaton.make_automaton()
+    return automaton
 
-def load_transactions(file):
+def prepare_chunk(batch, columns, debit_credit_dtype):
+    chunk = batch.to_pandas(types_mapper={pa.string(): pd.StringDtype()}.get)
+    chunk = chunk.rename(columns={col: name for name, col in columns.items()})
+    chunk["Details"] = chunk["Details"].str.strip()
+    chunk["Debit/Credit"] = pd.Categorical(
+        np.where(chunk["Amount"].to_numpy() > 0, "Credit", "Debit"),
+        dtype=debit_credit_dtype
+    )
+    return chunk[["Date", "Details", "Amount", "Debit/Credit"]]  # Ensure columns are in the right order
+
+@st.cache_data(show_spinner="Parsing CSV…", max_entries=8)
+def load_transactions(file_bytes, categories_hash):
+    # categories_hash keys the cache so files are recategorized when categories change
     try:
-        df = pd.read_csv(file, skipinitialspace=True)
-        df.columns = [col.strip() for col in df.columns]
+        # Sniff the header first so the full read can be typed by column name
+        header = pd.read_csv(io.BytesIO(file_bytes), nrows=0).columns
+        columns = {col.strip(): col for col in header}  # Clean name -> name in file
         
         # Handle Barclays format
-        if "Subcategory" in df.columns and "Memo" in df.columns:
-            # This is Barclays format
-            df = df[["Date", "Amount", "Memo"]]  # Select only needed columns
-            df = df.rename(columns={"Memo": "Details"})  # Rename Memo to Details
-        
-        df["Amount"] = df["Amount"].astype(float)
-        df["Date"] = pd.to_datetime(df["Date"], format="%d/%m/%Y")
-        df["Debit/Credit"] = df["Amount"].apply(lambda x: "Credit" if x > 0 else "Debit")
+        if "Subcategory" in columns and "Memo" in columns:
+            # This is Barclays format, where Memo holds the details
+            columns["Details"] = columns.pop("Memo")
         
         # Ensure we have all required columns
-        required_columns = ["Date", "Details", "Amount", "Debit/Credit"]
-        if not all(col in df.columns for col in required_columns):
+        required_columns = ["Date", "Details", "Amount"]
+        if not all(col in columns for col in required_columns):
             raise ValueError(f"Missing required columns. File must contain: {required_columns}")
         
-        df = df[required_columns]  # Ensure columns are in the right order
+        # Parse the file in blocks and categorize each block separately, so large
+        # files can be split across worker processes.
+        # Only the needed columns are parsed, so wide exports don't allocate the rest
+        reader = pa_csv.open_csv(
+            io.BytesIO(file_bytes),
+            read_options=pa_csv.ReadOptions(block_size=CSV_BLOCK_SIZE),
+            convert_options=pa_csv.ConvertOptions(
+                include_columns=[columns[col] for col in required_columns],
+                column_types={
+                    columns["Date"]: pa.timestamp("s"),
+                    columns["Details"]: pa.string(),
+                    columns["Amount"]: pa.float64()
+                },
+                timestamp_parsers=["%d/%m/%Y"]
+            )
+        )
+        
+        # Use compact dtypes to shrink memory and speed up grouping.
+        # Category keeps every known category so edits can pick any of them
+        category_dtype = pd.CategoricalDtype(
+            list(dict.fromkeys(["Uncategorized", *st.session_state.categories]))
+        )
+        debit_credit_dtype = pd.CategoricalDtype(["Credit", "Debit"])
+        
+        automaton = build_keyword_automaton(st.session_state.categories, categories_hash)
+        chunks = (prepare_chunk(batch, columns, debit_credit_dtype) for batch in reader)
+        
+        # Categorize large files across all cores; for small ones starting
+        # the worker processes costs more than it saves.
+        # Workers are spawned rather than forked from the multithreaded server
+        if file_bytes.count(b"\n") < PARALLEL_MIN_ROWS:
+            chunks = [categorize_transactions(chunk, automaton) for chunk in chunks]
+        else:
+            with ProcessPoolExecutor(
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=init_worker,
+                initargs=(automaton,)
+            ) as executor:
+                chunks = list(executor.map(categorize_chunk, chunks))
+        
+        # A file with a header but no rows yields no blocks
+        if not chunks:
+            empty_chunk = prepare_chunk(reader.schema.empty_table(), columns, debit_credit_dtype)
+            chunks = [categorize_transactions(empty_chunk, automaton)]
         
-        return categorize_transactions(df)
+        for chunk in chunks:
+            chunk["Category"] = chunk["Category"].astype(category_dtype)
+        df = pd.concat(chunks, ignore_index=True, copy=False)
+        del chunks
+        
+        return df
     except Exception as e:
         st.error(f"Error processing file: {str(e)}")
         return None
@@ -108,7 +187,7 @@ def extract_keyword(details):
 def add_keyword_to_category(category, details):
     keyword = extract_keyword(details).strip().upper()
     if keyword and keyword not in st.session_state.categories[category]:
-        st.session_state.categories[category].append(keyword)
+        st.session_state.categories[category].add(keyword)
         save_categories()
         return True
     return False
@@ -137,13 +216,15 @@ def main():
     uploaded_file = st.file_uploader("Upload your transaction CSV file", type=["csv"])
     
     if uploaded_file is not None:
-        df = load_transactions(uploaded_file)
+        df = load_transactions(
+            uploaded_file.getvalue(),
+            hash_categories(st.session_state.categories)
+        )
         
         if df is not None:
-            debits_df = df[df["Debit/Credit"] == "Debit"].copy()
-            credits_df = df[df["Debit/Credit"] == "Credit"].copy()
-            
-            st.session_state.debits_df = debits_df.copy()
+            st.session_state.debits_df = df[df["Debit/Credit"] == "Debit"].copy()
+            debits_df = st.session_state.debits_df
+            credits_df = df[df["Debit/Credit"] == "Credit"]
             
             tab1, tab2, tab3 = st.tabs(["Expenses (Debits)", "Income (Credits)", "Analysis"])
             
@@ -157,9 +238,9 @@ def main():
                 if add_button and new_category:
                     st.write(f"Adding new category: {new_category}")
                     if new_category not in st.session_state.categories:
-                        st.session_state.categories[new_category] = []
+                        st.session_state.categories[new_category] = set()
                         save_categories()
-                        st.write("Current categories after adding:", st.session_state.categories)
+                        st.write("Current categories after adding:", categories_to_json(st.session_state.categories))
                         st.rerun()
                 
                 st.subheader("Your Expenses")
@@ -181,33 +262,31 @@ def main():
                 save_button = st.button("Apply Changes", type="primary")
                 if save_button:
                     st.write("Saving changes...")  # Debug info
-                    for idx, row in edited_df.iterrows():
-                        new_category = row["Category"]
-                        old_category = st.session_state.debits_df.at[idx, "Category"]
-                        st.write(f"Transaction: {row['Details']}")  # Debug info
-                        st.write(f"Old category: {old_category}")  # Debug info
-                        st.write(f"New category: {new_category}")  # Debug info
-                        
-                        if new_category == old_category:
-                            continue
-                            
-                        details = row["Details"]
-                        st.session_state.debits_df.at[idx, "Category"] = new_category
-                        add_keyword_to_category(new_category, details)
+                    # Only process the transactions whose category was changed
+                    old_categories = st.session_state.debits_df.loc[edited_df.index, "Category"]
+                    changed = edited_df["Category"].astype(object).to_numpy() != old_categories.astype(object).to_numpy()
+                    changed_df = edited_df[changed]
+                    
+                    st.session_state.debits_df.loc[changed_df.index, "Category"] = changed_df["Category"].to_numpy()
+                    for row in changed_df[["Details", "Category"]].itertuples(index=False):
+                        add_keyword_to_category(row.Category, row.Details)
                     
                     # Add this to force save after all changes
                     save_categories()
-                    st.write("Current categories:", st.session_state.categories)  # Debug info
+                    st.write("Current categories:", categories_to_json(st.session_state.categories))  # Debug info
                 
                 col1, col2 = st.columns(2)
                 
                 with col1:
                     st.subheader('Expense Summary')
-                    category_totals = st.session_state.debits_df.groupby("Category")["Amount"].sum().reset_index()
-                    category_totals = category_totals.sort_values("Amount", ascending=True)
+                    # Totals are made positive once here, for both the bar and the pie chart
+                    category_totals = (
+                        st.session_state.debits_df.groupby("Category", observed=True)["Amount"]
+                        .sum().abs().sort_values().reset_index()
+                    )
                     
                     fig = go.Figure(go.Bar(
-                        x=category_totals["Amount"].abs(),
+                        x=category_totals["Amount"],
                         y=category_totals["Category"],
                         orientation='h'
                     ))
@@ -300,41 +379,41 @@ def main():
                 # Budget Tracking
                 track_budget_vs_actual(df)
 
+@st.cache_data(max_entries=4)
 def analyze_historical_trends(df):
     # Monthly spending trends - only look at amounts
-    monthly_spending = df.groupby(pd.Grouper(key='Date', freq='M'))['Amount'].sum().reset_index()
+    monthly_spending = df.groupby(pd.Grouper(key='Date', freq='ME'))['Amount'].sum().reset_index()
     
     # Category trends over time
     category_trends = df.pivot_table(
-        index=pd.Grouper(key='Date', freq='M'),
+        index=pd.Grouper(key='Date', freq='ME'),
         columns='Category',
         values='Amount',
-        aggfunc='sum'
+        aggfunc='sum',
+        observed=True
     ).fillna(0).reset_index()
     
     return monthly_spending, category_trends
 
+@st.cache_data(max_entries=4)
 def calculate_savings_projections(df):
     # Calculate average monthly income and expenses
-    monthly_net = df.groupby([df['Date'].dt.year, df['Date'].dt.month])['Amount'].sum()
+    # (months without transactions are dropped so they don't lower the average)
+    monthly_net = df.resample('ME', on='Date')['Amount'].sum(min_count=1).dropna()
     avg_monthly_net = monthly_net.mean()
     
     # Project next 12 months
     current_savings = monthly_net.sum()
-    projected_savings = [current_savings]
-    for _ in range(12):
-        projected_savings.append(projected_savings[-1] + avg_monthly_net)
-    
-    return projected_savings
+    return current_savings + np.arange(13) * avg_monthly_net
 
 def save_historical_data(df):
     # Create a directory for historical data if it doesn't exist
     if not os.path.exists('historical_data'):
         os.makedirs('historical_data')
     
-    # Save the current month's data
+    # Save the current month's data as Parquet, which keeps dtypes and rereads much faster than CSV
     month_year = df['Date'].max().strftime('%Y_%m')
-    df.to_csv(f'historical_data/{month_year}.csv', index=False)
+    df.to_parquet(f'historical_data/{month_year}.parquet', compression='zstd', index=False)
 
 def track_budget_vs_actual(df):
     # Set budget limits per category
@@ -342,6 +421,8 @@ def track_budget_vs_actual(df):
         st.session_state.budget_limits = {}
     
     st.subheader("Budget Tracking")
+    # Total spending for every category in a single pass over the data
+    actuals = df.groupby('Category', observed=True)['Amount'].sum().abs()
     for category in df['Category'].unique():
         if category not in st.session_state.budget_limits:
             st.session_state.budget_limits[category] = 0
@@ -353,11 +434,13 @@ def track_budget_vs_actual(df):
                 value=st.session_state.budget_limits[category]
             )
         with col2:
-            actual_spending = abs(df[df['Category'] == category]['Amount'].sum())
+            actual_spending = actuals.get(category, 0.0)
             progress = actual_spending / st.session_state.budget_limits[category] if st.session_state.budget_limits[category] > 0 else 0
             st.progress(min(progress, 1.0))
             st.write(f"Spent: £{actual_spending:.2f}")
 
-main()
+# Spawned worker processes import this script as __mp_main__ and must not render the app
+if __name__ == "__main__":
+    main()
 
 # def fix_csv_format('AutomateFinancesWithPython/barclays april.csv', 'AutomateFinancesWithPython/barclays_april_fixed.csv')